@@ -6,17 +6,20 @@
 
 
 import asyncio
+import gzip
+import hashlib
 import logging
+import mimetypes
 import os
-from copy import deepcopy
-from datetime import datetime, timedelta
+import time
+from math import log10
 
-import numpy as np
+import msgspec
+import orjson
 import skyfield.almanac
 import skyfield.api
-import ujson
 import uvloop
-from aiohttp import ClientSession, ClientTimeout, web
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
 from aiohttp_sse import sse_response
 from gpiozero import DigitalOutputDevice
 
@@ -41,18 +44,18 @@ class ColoredFormatter(logging.Formatter):
             "grey": "\x1b[37;20m", "bold_grey": "\x1b[37;1m",
             "reset": "\x1b[0m"
         }
-        self._default_formatter = logging.Formatter(fmt)
-        self._formatters = {
-            100: logging.Formatter(colors["bold_blue"] + fmt + colors["reset"]),
-            logging.DEBUG: logging.Formatter(colors["grey"] + fmt + colors["reset"]),
-            logging.INFO: logging.Formatter(colors["green"] + fmt + colors["reset"]),
-            logging.WARNING: logging.Formatter(colors["yellow"] + fmt + colors["reset"]),
-            logging.ERROR: logging.Formatter(colors["red"] + fmt + colors["reset"]),
-            logging.CRITICAL: logging.Formatter(colors["bold_red"] + fmt + colors["reset"])
+        self._wrappers = {
+            100: (colors["bold_blue"], colors["reset"]),
+            logging.DEBUG: (colors["grey"], colors["reset"]),
+            logging.INFO: (colors["green"], colors["reset"]),
+            logging.WARNING: (colors["yellow"], colors["reset"]),
+            logging.ERROR: (colors["red"], colors["reset"]),
+            logging.CRITICAL: (colors["bold_red"], colors["reset"])
         }
 
-    def format(self, record):
-        return self._formatters.get(record.levelno, self._default_formatter).format(record)
+    def formatMessage(self, record):
+        prefix, suffix = self._wrappers.get(record.levelno, ("", ""))
+        return prefix + super().formatMessage(record) + suffix
 
 (logger := logging.getLogger(__name__)).setLevel(logging.DEBUG)
 logger.propagate = False
@@ -61,10 +64,9 @@ logger.addHandler(logger_handler)
 
 SCRIPT_PATH = os.path.abspath(os.path.dirname(__file__))
 
-relays = {
-    "main":  DigitalOutputDevice(pin="GPIO2", active_high=False),
-    "guide": DigitalOutputDevice(pin="GPIO3", active_high=False)
-}
+def json_dumps(obj) -> str:
+    """ JSON serializer based on orjson, returning a string as expected by aiohttp. """
+    return orjson.dumps(obj).decode()
 
 
 #####################################################################
@@ -74,22 +76,26 @@ relays = {
 class DewHeaterHandler():
     """ Dew heater updater class, with utility functions to handle. """
 
-    _updater_lock = asyncio.Lock()
-
-    def __init__(self, relays: dict[str, DigitalOutputDevice], site_latitude: float,
-                 site_longitude: float, site_elevation: float, auto_update: bool = True,
-                 temp_threshold: float = 4, time_threshold: int = 1800) -> None:
+    def __init__(self, relays: dict[str, DigitalOutputDevice], http_session: ClientSession,
+                 site_latitude: float, site_longitude: float, site_elevation: float,
+                 auto_update: bool = True, temp_threshold: float = 4, time_threshold: int = 1800) -> None:
+        self._updater_lock = asyncio.Lock()
+        self._relays_lock = asyncio.Lock()
         self._status = {"auto": auto_update}
+        self._status_payload = ""
+        self._subscribers: set[asyncio.Queue[str | None]] = set()
         self._relays = relays
+        self._http_session = http_session
         self._update_relay_status()
         # setup location for Sun altitude
         self._ts_skyfield = skyfield.api.load.timescale()
         self._site = skyfield.api.wgs84.latlon(site_latitude, site_longitude, site_elevation)
         self._sun_is_up = skyfield.almanac.sunrise_sunset(skyfield.api.load("de421.bsp"), self._site)
+        self._sun_cache = (0.0, False)  # (next sunrise/sunset TT julian date, Sun is up)
         # setup threshold
         self._temp_threshold = temp_threshold
         self._time_threshold = time_threshold
-        self._time = datetime.utcnow() - timedelta(seconds=self._time_threshold+1)
+        self._time = time.monotonic() - self._time_threshold - 1
 
     @property
     def status(self) -> dict:
@@ -102,142 +108,261 @@ class DewHeaterHandler():
     @auto_update.setter
     def auto_update(self, value: bool) -> None:
         self._status["auto"] = value
+        self._notify_status_change()
 
     @property
     def relays(self) -> dict[str, DigitalOutputDevice]:
         return self._relays
 
+    @property
+    def http_session(self) -> ClientSession:
+        return self._http_session
+
+    async def close(self) -> None:
+        """ Close the http session and release the relays, once the pending switches are done. """
+        await self.http_session.close()
+        async with self._relays_lock:
+            for relay in self.relays.values():
+                relay.close()
+
+    def subscribe(self, max_queued: int = 8) -> asyncio.Queue[str | None]:
+        """ Get a queue receiving the serialized status at every change, then None if dropped for falling behind. """
+        queue = asyncio.Queue(maxsize=max_queued)
+        queue.put_nowait(self._status_payload)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue[str | None]) -> None:
+        self._subscribers.discard(queue)
+
+    def _drop_subscriber(self, queue: asyncio.Queue[str | None]) -> None:
+        # discard the pending messages and signal the drop
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+        self.unsubscribe(queue)
+
+    async def drop_subscribers(self) -> None:
+        """ Drop all the subscribers, e.g. to end the SSE streams at shutdown. """
+        for queue in list(self._subscribers):
+            self._drop_subscriber(queue)
+
+    def _notify_status_change(self) -> None:
+        # serialize once for all the subscribers, skipping unchanged status
+        if (payload := json_dumps(self._status)) != self._status_payload:
+            self._status_payload = payload
+            for queue in list(self._subscribers):
+                try:
+                    queue.put_nowait(payload)
+                except asyncio.QueueFull:
+                    # subscriber fallen behind
+                    self._drop_subscriber(queue)
+
     def _update_relay_status(self) -> None:
         self._status.update({"telescope": {telescope: relay.is_active for telescope, relay in self.relays.items()}})
-
-    def relay_on(self, relay: str) -> None:
-        if not self.relays[relay].is_active:
-            self.relays[relay].on()
-            self._update_relay_status()
-
-    def relay_off(self, relay: str) -> None:
-        if self.relays[relay].is_active:
-            self.relays[relay].off()
-            self._update_relay_status()
+        self._notify_status_change()
+
+    def _switch_relays(self, changes: dict[str, bool]) -> None:
+        # blocking GPIO calls, to be run outside the event loop
+        for telescope, value in changes.items():
+            (self.relays[telescope].on if value else self.relays[telescope].off)()
+
+    async def _apply_relays(self, desired: dict[str, bool]) -> None:
+        async with self._relays_lock:
+            changes = {telescope: value for telescope, value in desired.items() if self._status["telescope"][telescope] != value}
+            if changes:
+                await asyncio.get_running_loop().run_in_executor(None, self._switch_relays, changes)
+                self._status["telescope"] = self._status["telescope"] | changes
+                self._notify_status_change()
+
+    async def apply_relays(self, desired: dict[str, bool]) -> None:
+        """ Switch the relays that differ from the desired state, shielded from cancellation to keep the status in sync. """
+        await asyncio.shield(self._apply_relays(desired))
+
+    async def relay_on(self, relay: str) -> None:
+        await self.apply_relays({relay: True})
+
+    async def relay_off(self, relay: str) -> None:
+        await self.apply_relays({relay: False})
+
+    def _is_sun_up(self) -> bool:
+        """ Check if the Sun is up, computing it again only after the next sunrise or sunset. """
+        now = self._ts_skyfield.now()
+        if now.tt >= self._sun_cache[0]:
+            tomorrow = self._ts_skyfield.tt_jd(now.tt + 1)
+            transitions, _ = skyfield.almanac.find_discrete(now, tomorrow, self._sun_is_up)
+            self._sun_cache = (transitions[0].tt if len(transitions) else tomorrow.tt, bool(self._sun_is_up(now)))
+        return self._sun_cache[1]
 
     async def _get_meteo_data(self) -> tuple[float]:
         """ Function to get temperature and humidity at the telescope location. """
-        async with ClientSession(timeout=ClientTimeout(total=5)) as session:
-            async with session.get("https://astrogeo.va.it/data/stazioni/cdf.json") as resp:
-                meteo_data = await resp.json(loads=ujson.loads)
+        async with self.http_session.get("https://astrogeo.va.it/data/stazioni/cdf.json") as resp:
+            meteo_data = await resp.json(loads=orjson.loads)
         return float(meteo_data["tempcorr"]), float(meteo_data["rhcorr"])
 
     async def update_status(self) -> None:
         if self.auto_update:
             async with self._updater_lock:
-                if self._sun_is_up(self._ts_skyfield.now()):
+                if self._is_sun_up():
                     logger.info("System disabled (daily hours)")
-                    for telescope in self.relays:
-                        self.relay_off(telescope)
+                    await self.apply_relays({telescope: False for telescope in self.relays})
                 else:
                     logger.info("Starting auto update routine")
                     try:
                         temperature, humidity = await self._get_meteo_data()
-                        # compute dewpoint
-                        a, m, Tn = 6.116441, 7.591386, 240.7263
-                        Pws = a * 10**(m * temperature / (temperature + Tn))
-                        Pw = Pws * humidity / 100
-                        dew_point = round(Tn / ((m / np.log10(Pw / a)) - 1), 1)
+                        # compute dewpoint, using log10(Pw / a) = m * T / (T + Tn) + log10(RH / 100)
+                        m, Tn = 7.591386, 240.7263
+                        if humidity > 0:
+                            x = m * temperature / (temperature + Tn) + log10(humidity * 0.01)
+                            dew_point = round(Tn * x / (m - x), 1)
+                        else:
+                            # limit for RH -> 0, where log10 diverges
+                            dew_point = round(-Tn, 1)
                     except Exception as e:
                         logger.exception(e)
                         logger.info("System disabled (error retriving parameters)")
-                        for telescope in self.relays:
-                            self.relay_off(telescope)
+                        await self.apply_relays({telescope: False for telescope in self.relays})
                     else:
                         logger.info(f"Temperature: {temperature} °C, Dew Point: {dew_point} °C")
                         delta = temperature - dew_point
                         if delta < self._temp_threshold:
                             logger.info("System enabled")
-                            self._time = datetime.utcnow()
-                            for telescope in self.relays:
-                                self.relay_on(telescope)
-                        elif delta > self._temp_threshold and (datetime.utcnow() - self._time).seconds > self._time_threshold:
+                            self._time = time.monotonic()
+                            await self.apply_relays({telescope: True for telescope in self.relays})
+                        elif delta > self._temp_threshold and time.monotonic() - self._time > self._time_threshold:
                             logger.info("System disabled")
-                            for telescope in self.relays:
-                                self.relay_off(telescope)
+                            await self.apply_relays({telescope: False for telescope in self.relays})
                         else:
                             logger.info("Waiting for disabling system")
 
-updater = DewHeaterHandler(relays, 45.86833333, 8.77055556, 1226)
-
 
 #####################################################################
 # WEBSERVER
 
 
+class ApiSetParams(msgspec.Struct, forbid_unknown_fields=True):
+    """ Parameters of the "set" API command, all optional. """
+    auto: bool | msgspec.UnsetType = msgspec.UNSET
+    telescope: dict[str, bool] | msgspec.UnsetType = msgspec.UNSET
+
+class ApiSetCommand(msgspec.Struct, tag_field="cmd", tag="set"):
+    """ "set" API command. """
+    params: ApiSetParams
+
+class ApiStatusCommand(msgspec.Struct, tag_field="cmd", tag="status"):
+    """ "status" API command. """
+    params: msgspec.UnsetType = msgspec.UNSET  # any "params" value is rejected
+
+api_decoder = msgspec.json.Decoder(ApiSetCommand | ApiStatusCommand)
+
+API_MAX_JSON_LENGTH = 4096
+
 routes = web.RouteTableDef()
 
+def load_static_files() -> dict[str, tuple[str, str, bytes, bytes]]:
+    """ Load the web page files in memory, with their content type, ETag and gzip compressed body. """
+    static_files = {}
+    for file in os.listdir(f"{SCRIPT_PATH}/html"):
+        with open(f"{SCRIPT_PATH}/html/{file}", "rb") as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(file)[0] or "application/octet-stream"
+        static_files[file] = (content_type, hashlib.blake2b(body).hexdigest()[:16], body, gzip.compress(body, mtime=0))
+    return static_files
+
+def accepts_gzip(request: web.Request) -> bool:
+    """ Check if the Accept-Encoding header of the request allows the gzip content coding. """
+    qvalues = {}
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        name, *params = coding.split(";")
+        qvalue = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+    return qvalues.get("gzip", qvalues.get("*", 0.0)) > 0
+
+def static_response(request: web.Request, file: str) -> web.Response:
+    """ Build the response for a static file loaded in memory, gzip compressed if accepted by the client. """
+    if file not in request.app["static"]:
+        raise web.HTTPNotFound()
+    content_type, etag, body, gzip_body = request.app["static"][file]
+    headers = {"Cache-Control": "max-age=3600", "Vary": "Accept-Encoding"}
+    gzip_encoding = accepts_gzip(request)
+    headers["ETag"] = f'"{etag}-gzip"' if gzip_encoding else f'"{etag}"'
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return web.Response(status=304, headers=headers)
+    if gzip_encoding:
+        body = gzip_body
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(body=body, content_type=content_type, headers=headers)
+
 @routes.get("/")
 async def webserver_route_root(request: web.Request):
-    return web.FileResponse(f"{SCRIPT_PATH}/html/index.html")
+    return static_response(request, "index.html")
 
 @routes.get("/static/{file}")
 async def webserver_route_static(request: web.Request):
-    return web.FileResponse(f"{SCRIPT_PATH}/html/{request.match_info['file']}")
+    return static_response(request, request.match_info["file"])
 
 @routes.get("/api")
 async def webserver_route_api(request: web.Request):
+    updater = request.app["updater"]
     params = request.rel_url.query
     headers = {"Access-Control-Allow-Origin": "*"}
     # check "json" param
     if "json" in params:
+        # reject long requests before parsing
+        if len(params["json"]) > API_MAX_JSON_LENGTH:
+            return web.json_response({"rsp": "Error: request too long"}, status=400, headers=headers, dumps=json_dumps)
         # try parse and check syntax
         try:
-            data = ujson.loads(params["json"])
-            assert "cmd" in data
-            assert data["cmd"] in ("set", "status")
-            if data["cmd"] == "set":
-                assert "params" in data and data["params"]
-                assert set(data["params"]) <= {"auto", "telescope"}
-                if "auto" in data["params"]:
-                    assert isinstance(data["params"]["auto"], bool)
-                if "telescope" in data["params"]:
-                    assert set(data["params"]["telescope"]) <= set(updater.relays)
-                    for telescope in data["params"]["telescope"]:
-                        assert isinstance(data["params"]["telescope"][telescope], bool)
-            elif data["cmd"] == "status":
-                assert "params" not in data
-        except Exception:
-            return web.json_response({"rsp": "Error: wrong json format"}, status=400, headers=headers, dumps=ujson.dumps)
+            data = api_decoder.decode(params["json"])
+            if isinstance(data, ApiSetCommand):
+                if data.params == ApiSetParams():
+                    raise msgspec.ValidationError("Empty params")
+                if data.params.telescope is not msgspec.UNSET and not set(data.params.telescope) <= set(updater.relays):
+                    raise msgspec.ValidationError("Unknown telescope")
+        except msgspec.MsgspecError:
+            return web.json_response({"rsp": "Error: wrong json format"}, status=400, headers=headers, dumps=json_dumps)
         # set
-        if data["cmd"] == "set":
-            if "auto" in data["params"]:
-                updater.auto_update = data["params"]["auto"]
+        if isinstance(data, ApiSetCommand):
+            if data.params.auto is not msgspec.UNSET:
+                updater.auto_update = data.params.auto
                 logger.info(f"Auto update {'enabled' if updater.auto_update else 'disabled'}")
                 await updater.update_status()
-            if "telescope" in data["params"]:
+            if data.params.telescope is not msgspec.UNSET:
                 if updater.auto_update:
                     logger.error("Controller in automatic mode, enable manual mode first")
-                    return web.json_response({"rsp": "Error: controller in automatic mode, enable manual mode first"}, headers=headers, dumps=ujson.dumps)
-                for telescope in updater.relays:
-                    if telescope in data["params"]["telescope"]:
-                        logger.info(f"{telescope.capitalize()} {'enabled' if data['params']['telescope'][telescope] else 'disabled'}")
-                        (updater.relay_on if data["params"]["telescope"][telescope] else updater.relay_off)(telescope)
-            return web.json_response({"rsp": "done"}, headers=headers, dumps=ujson.dumps)
+                    return web.json_response({"rsp": "Error: controller in automatic mode, enable manual mode first"}, headers=headers, dumps=json_dumps)
+                for telescope, value in data.params.telescope.items():
+                    logger.info(f"{telescope.capitalize()} {'enabled' if value else 'disabled'}")
+                await updater.apply_relays(data.params.telescope)
+            return web.json_response({"rsp": "done"}, headers=headers, dumps=json_dumps)
         # status
-        elif data["cmd"] == "status":
-            return web.json_response({"rsp": updater.status}, headers=headers, dumps=ujson.dumps)
+        elif isinstance(data, ApiStatusCommand):
+            return web.json_response({"rsp": updater.status}, headers=headers, dumps=json_dumps)
         # command error
         else:
-            return web.json_response({"rsp": "Error: unknown request"}, status=400, headers=headers, dumps=ujson.dumps)
+            return web.json_response({"rsp": "Error: unknown request"}, status=400, headers=headers, dumps=json_dumps)
     # param error
     else:
-        return web.json_response({"rsp": "Error: unknown params"}, status=400, headers=headers, dumps=ujson.dumps)
+        return web.json_response({"rsp": "Error: unknown params"}, status=400, headers=headers, dumps=json_dumps)
 
 @routes.get("/status-sse")
 async def webserver_route_status_sse(request: web.Request):
+    updater = request.app["updater"]
     async with sse_response(request) as resp:
-        last_status = {}
-        while True:
-            if updater.status != last_status:
-                await resp.send(ujson.dumps(updater.status))
-                last_status = deepcopy(updater.status)
-            await asyncio.sleep(0.1)
+        queue = updater.subscribe()
+        try:
+            # a None message means that the client is too slow, close the connection to let it reconnect
+            while (payload := await queue.get()) is not None:
+                await resp.send(payload)
+        finally:
+            updater.unsubscribe(queue)
     return resp
 
 
@@ -247,10 +372,27 @@ async def webserver_route_status_sse(request: web.Request):
 
 async def main():
 
+    logger.debug(f"Event loop: {type(asyncio.get_running_loop())}")
+
+    # UPDATER
+
+    # setup relays and updater, with a long-lived http session to keep connections alive
+    relays = {
+        "main":  DigitalOutputDevice(pin="GPIO2", active_high=False),
+        "guide": DigitalOutputDevice(pin="GPIO3", active_high=False)
+    }
+    http_session = ClientSession(connector=TCPConnector(limit_per_host=2, ttl_dns_cache=3600),
+                                 timeout=ClientTimeout(total=5), json_serialize=json_dumps)
+    updater = DewHeaterHandler(relays, http_session, 45.86833333, 8.77055556, 1226)
+
     # WEBSERVER
 
     # setup application
     webserver = web.Application()
+    webserver["static"] = load_static_files()
+    webserver["updater"] = updater
+    webserver.on_shutdown.append(lambda app: app["updater"].drop_subscribers())
+    webserver.on_cleanup.append(lambda app: app["updater"].close())
     webserver.add_routes(routes)
 
     # setup runner and start site
@@ -261,17 +403,19 @@ async def main():
 
     logger.info("Webserver started!")
 
-    # UPDATER
+    # start updater
 
     logger.info("Updater started!")
-    while True:
-        await updater.update_status()
-        await asyncio.sleep(180)
+    try:
+        while True:
+            await updater.update_status()
+            await asyncio.sleep(180)
+    finally:
+        await runner.cleanup()
 
 
 try:
     logger.log(100, "[MAIN] Starting app: dew_heater")
-    uvloop.install()
-    asyncio.run(main())
+    uvloop.run(main())
 except (KeyboardInterrupt, SystemExit):
     logger.log(100, "[MAIN] Interrupt detected, exit")